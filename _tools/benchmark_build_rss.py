@@ -0,0 +1,72 @@
+"""
+Compare the title cleaning and date parsing of build_rss with the BeautifulSoup
+and dateutil versions they replaced, on the entries of some feeds.
+
+    > python _tools/benchmark_build_rss.py feed.xml https://example.com/feed
+"""
+
+import argparse
+import datetime
+import time
+from typing import Callable, List
+
+import feedparser
+from bs4 import BeautifulSoup
+from dateutil.parser import parse
+
+from build_rss import parse_entry_date, remove_html_tags
+
+
+def remove_html_tags_soup(text: str) -> str:
+    return BeautifulSoup(text, "html.parser").get_text()
+
+
+def parse_entry_date_dateutil(
+    entry: feedparser.FeedParserDict,
+) -> datetime.datetime:
+    return parse(
+        entry.get("published") or entry.get("updated"), ignoretz=True, fuzzy=True
+    )
+
+
+def best_time(function: Callable, inputs: List, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in inputs:
+            function(value)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("feeds", nargs="+", help="Paths or URLs of RSS/Atom feeds.")
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    entries = [entry for feed in args.feeds for entry in feedparser.parse(feed).entries]
+    titles = [entry.get("title", "") for entry in entries]
+    dated = [
+        entry for entry in entries if entry.get("published") or entry.get("updated")
+    ]
+    benchmarks = [
+        ("titles", titles, remove_html_tags_soup, remove_html_tags),
+        ("dates", dated, parse_entry_date_dateutil, parse_entry_date),
+    ]
+    print(f"{len(entries)} entries, best of {args.repeat}")
+    for name, inputs, old, new in benchmarks:
+        # Titles with malformed entities like "R&D" are expected to differ
+        different = sum(old(value) != new(value) for value in inputs)
+        print(
+            f"{name:>6}: {best_time(old, inputs, args.repeat) * 1000:.1f}ms -> "
+            f"{best_time(new, inputs, args.repeat) * 1000:.1f}ms, "
+            f"{different} of {len(inputs)} different"
+        )
+
+
+if __name__ == "__main__":
+    main()
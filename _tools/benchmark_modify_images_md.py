@@ -0,0 +1,100 @@
+r"""
+Compare modify_image_syntax with the regex it replaced, on the posts and on
+adversarial inputs made of image tags that are never closed by "_\n\n", where
+the regex backtracks polynomially.
+
+    > python _tools/benchmark_modify_images_md.py --sizes 10 20 25
+"""
+
+import argparse
+import os
+import re
+import time
+from typing import Callable, List, Tuple
+
+from modify_images_md import modify_image_syntax
+
+# The regex used before modify_image_syntax was rewritten without backtracking
+IMAGE_RE = re.compile(
+    r"!\[(.*?)\]\((.*?)\)\{: width=(.*?) height=(.*?)\}\n_(.*?)_\n\n", re.DOTALL
+)
+UNCLOSED_TAG = "![alt](src){: width=1 height=2}\n_caption_\n"
+
+
+def modify_image_syntax_regex(content: str) -> str:
+    return IMAGE_RE.sub(
+        r'<figure>\n    <img src="\2" alt="\1" width=\3 class="center" />\n  <figcaption class="center">\5</figcaption>\n</figure>\n\n',
+        content,
+    )
+
+
+def best_time(
+    function: Callable[[str], str], contents: List[str], repeat: int
+) -> float:
+    """Best time, out of `repeat`, to process each of `contents` separately."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in contents:
+            function(content)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def read_posts(folder_path: str) -> List[str]:
+    if not os.path.isdir(folder_path):
+        return []
+    contents = []
+    for filename in sorted(os.listdir(folder_path)):
+        if filename.endswith(".md"):
+            with open(os.path.join(folder_path, filename)) as file:
+                contents.append(file.read())
+    return contents
+
+
+def benchmark(
+    folder_path: str, sizes: List[int], repeat: int
+) -> List[Tuple[str, float, float]]:
+    """Best time of the regex and of modify_image_syntax on each input."""
+    inputs = [(f"{folder_path}/*.md", read_posts(folder_path))]
+    inputs += [(f"{size} unclosed tags", [UNCLOSED_TAG * size]) for size in sizes]
+    results = []
+    for name, contents in inputs:
+        for content in contents:
+            if modify_image_syntax(content) != modify_image_syntax_regex(content):
+                raise AssertionError(f"Different output on {name}")
+        results.append(
+            (
+                name,
+                best_time(modify_image_syntax_regex, contents, repeat),
+                best_time(modify_image_syntax, contents, repeat),
+            )
+        )
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("folder_path", nargs="?", default="_posts")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[5, 10, 20],
+        help="Numbers of unclosed image tags of the adversarial inputs.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print(f"{'input':>24} {'regex':>10} {'linear':>10}")
+    for name, regex_time, linear_time in benchmark(
+        args.folder_path, args.sizes, args.repeat
+    ):
+        print(f"{name:>24} {regex_time * 1000:>8.2f}ms {linear_time * 1000:>8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
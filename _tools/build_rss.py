@@ -1,17 +1,70 @@
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.error import HTTPError
 from urllib.parse import urlparse
+from urllib.request import Request, urlopen
 import feedparser
+import argparse
 import datetime
+import heapq
+import html
+import json
+import os
+import re
+import statistics
+import threading
+import time
 from dateutil.parser import parse
 
 from tqdm import tqdm
 from bs4 import BeautifulSoup
 
+FEEDS_STATE_PATH = "_tools/.feeds-state.json"
+TAG_RE = re.compile(r"<[^<>]*>")
+BLOGROLL_PATH = "_layouts/blogroll.html"
+WINDOW_DAYS = 30
+# After this many consecutive failures a feed is only retried after a backoff,
+# which doubles with each new failure.
+FAILURES_BEFORE_BACKOFF = 3
+BACKOFF = datetime.timedelta(hours=6)
+MAX_BACKOFF = datetime.timedelta(days=7)
+FETCH_TIMES_KEPT = 10
+READ_CHUNK_SIZE = 64 * 1024
+
+Link = Tuple[str, str, datetime.datetime]
+
 
 def remove_html_tags(text: str) -> str:
-    soup = BeautifulSoup(text, "html.parser")
-    cleaned_text = soup.get_text()
-    return cleaned_text
+    if "<" not in text:
+        return html.unescape(text) if "&" in text else text
+    stripped = TAG_RE.sub("", text)
+    if "<" in stripped or ">" in stripped:
+        # Unbalanced markup, let BeautifulSoup figure it out.
+        soup = BeautifulSoup(text, "html.parser")
+        return soup.get_text()
+    return html.unescape(stripped)
+
+
+def parse_entry_date(entry: feedparser.FeedParserDict) -> datetime.datetime:
+    """
+    Publication date of an entry, or its last update if it has none, in the
+    feed's own local time (the offset is dropped, not converted to UTC). RSS and
+    ISO 8601 dates are parsed with the standard library, so dateutil's fuzzy
+    parsing is only needed for the odd formats.
+    """
+    date = entry.get("published") or entry.get("updated")
+    try:
+        return parsedate_to_datetime(date).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        pass
+    try:
+        # fromisoformat only understands the Z suffix since Python 3.11
+        return datetime.datetime.fromisoformat(
+            re.sub(r"Z$", "+00:00", date)
+        ).replace(tzinfo=None)
+    except ValueError:
+        return parse(date, ignoretz=True, fuzzy=True)
 
 
 def get_base_url(feed_url: str) -> str:
@@ -32,28 +85,246 @@ def read_websites(filename: str) -> List[str]:
         return file.read().splitlines()
 
 
-def write_html_with_updates(entries: List[feedparser.FeedParserDict]) -> None:
-    today = datetime.datetime.today()
-    three_months_ago = today - datetime.timedelta(days=30)
+def read_feeds_state(filename: str) -> Dict[str, dict]:
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as file:
+        return json.load(file)
 
-    links = []
-    for entry in tqdm(entries):
-        if not hasattr(entry, "links"):
-            continue
-        url = entry.links[0]['href']
-        title = entry.title
-        try:
-            d = entry.get("published") or entry.get("updated")
-            published_date = parse(d, ignoretz=True, fuzzy=True)
-        except Exception:
-            print("Skipping: ", url)
+
+def write_feeds_state(filename: str, state: Dict[str, dict]) -> None:
+    # Written aside and renamed, so an interrupted run leaves the old state
+    tmp_path = f"{filename}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(state, file)
+    os.replace(tmp_path, filename)
+
+
+def entry_key(entry: feedparser.FeedParserDict) -> Optional[str]:
+    if entry.get("id"):
+        return entry.id
+    if entry.get("links"):
+        return entry.links[0]["href"]
+    return None
+
+
+def parse_entry(entry: feedparser.FeedParserDict) -> Optional[dict]:
+    """
+    Normalize an entry into the url, cleaned title and publication date (in ISO
+    format) used by the blogroll. The date is `None` if it can't be parsed.
+    """
+    if not entry.get("links"):
+        return None
+    url = entry.links[0]["href"]
+    try:
+        published_date = parse_entry_date(entry).isoformat()
+    except Exception:
+        print("Skipping: ", url)
+        published_date = None
+    return {
+        "url": url,
+        "title": remove_html_tags(entry.get("title", "")),
+        "date": published_date,
+    }
+
+
+def read_body(response, deadline: float) -> bytes:
+    """Read a response, giving up if it's still arriving at `deadline`."""
+    chunks = []
+    while chunk := response.read1(READ_CHUNK_SIZE):
+        chunks.append(chunk)
+        if time.monotonic() > deadline:
+            raise TimeoutError("the feed took too long to download")
+    return b"".join(chunks)
+
+
+def fetch_feed(url: str, feed_state: dict, timeout: float) -> Tuple[dict, int]:
+    """
+    Fetch a feed sending the ETag and Last-Modified of the previous fetch, if any.
+    Unchanged feeds answer 304 and keep their stored entries. Otherwise only the
+    entries that aren't in the store yet are parsed. Returns the new state of the
+    feed, with its entries keyed by id or link, and the number of bytes received.
+    The download is aborted if it takes more than `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    stored = feed_state.get("items", {})
+    request = Request(url, headers={"User-Agent": "alexmolas.com blogroll"})
+    if "items" in feed_state:
+        if etag := feed_state.get("etag"):
+            request.add_header("If-None-Match", etag)
+        if modified := feed_state.get("modified"):
+            request.add_header("If-Modified-Since", modified)
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            body = read_body(response, deadline)
+            headers = response.headers
+    except HTTPError as e:
+        if e.code == 304:
+            return feed_state, 0
+        raise
+    feed = feedparser.parse(
+        body,
+        response_headers={
+            "content-location": url,
+            "content-type": headers.get("Content-Type", ""),
+        },
+    )
+    items = {}
+    for entry in feed.entries:
+        key = entry_key(entry)
+        if key is None or key in items:
             continue
-        if published_date >= three_months_ago:
-            links.append((url, title, published_date))
+        if key in stored:
+            items[key] = stored[key]
+        elif (item := parse_entry(entry)) is not None:
+            items[key] = item
+    new_state = {
+        "etag": headers.get("ETag"),
+        "modified": headers.get("Last-Modified"),
+        "items": items,
+    }
+    return new_state, len(body)
+
+
+def record_success(
+    health: dict, fetch_time: float, n_bytes: int, now: datetime.datetime
+) -> dict:
+    fetch_times = health.get("fetch_times", []) + [round(fetch_time, 3)]
+    return {
+        "last_success": now.isoformat(),
+        "consecutive_failures": 0,
+        "fetch_times": fetch_times[-FETCH_TIMES_KEPT:],
+        "bytes": n_bytes,
+    }
+
+
+def record_failure(health: dict, error: Exception, now: datetime.datetime) -> dict:
+    """
+    Count a failure. After `FAILURES_BEFORE_BACKOFF` of them in a row the feed
+    isn't fetched again until `retry_after`.
+    """
+    failures = health.get("consecutive_failures", 0) + 1
+    health = {**health, "consecutive_failures": failures, "last_error": str(error)}
+    if failures >= FAILURES_BEFORE_BACKOFF:
+        backoff = min(BACKOFF * 2 ** (failures - FAILURES_BEFORE_BACKOFF), MAX_BACKOFF)
+        health["retry_after"] = (now + backoff).isoformat()
+    return health
+
+
+def is_backing_off(health: dict, now: datetime.datetime) -> bool:
+    retry_after = health.get("retry_after")
+    return retry_after is not None and now.isoformat() < retry_after
+
+
+def fetch_feeds(
+    websites: List[str],
+    state: Dict[str, dict],
+    max_workers: int = 16,
+    max_per_host: int = 2,
+    timeout: float = 20,
+) -> Dict[str, dict]:
+    """
+    Fetch all the feeds concurrently, with at most `max_per_host` connections to
+    the same host and `timeout` seconds for each feed. Feeds that fail keep their
+    previous state, and the ones that keep failing are skipped until their backoff
+    expires (see `record_failure`). The health of each feed is stored in its state.
+    """
+    now = datetime.datetime.now()
+    host_limits = {
+        urlparse(website).netloc: threading.Semaphore(max_per_host)
+        for website in websites
+    }
+
+    def fetch(website: str) -> Tuple[dict, float, int]:
+        with host_limits[urlparse(website).netloc]:
+            start = time.monotonic()
+            feed_state, n_bytes = fetch_feed(website, state.get(website, {}), timeout)
+            return feed_state, time.monotonic() - start, n_bytes
+
+    new_state = {}
+    to_fetch = []
+    for website in websites:
+        if is_backing_off(state.get(website, {}).get("health", {}), now):
+            new_state[website] = state[website]
+        else:
+            to_fetch.append(website)
+    if len(to_fetch) < len(websites):
+        print(f"Skipping {len(websites) - len(to_fetch)} feeds that keep failing.")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, website): website for website in to_fetch}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            website = futures[future]
+            feed_state = state.get(website, {})
+            health = feed_state.get("health", {})
+            try:
+                feed_state, fetch_time, n_bytes = future.result()
+                health = record_success(health, fetch_time, n_bytes, now)
+            except Exception as e:
+                print("Failed: ", website, e)
+                health = record_failure(health, e, now)
+            new_state[website] = {**feed_state, "health": health}
+    return {website: new_state[website] for website in websites}
 
-    sorted_links = sorted(links, key=lambda x: x[2], reverse=True)
 
-    html = """---
+def report_feeds_health(state: Dict[str, dict], n: int = 5) -> None:
+    """Print the feeds that take the longest to fetch and the ones failing."""
+    healths = {website: s.get("health", {}) for website, s in state.items()}
+    median_times = {
+        website: statistics.median(health["fetch_times"])
+        for website, health in healths.items()
+        if health.get("fetch_times")
+    }
+    slowest = heapq.nlargest(n, median_times.items(), key=lambda x: x[1])
+    if slowest:
+        print("Slowest feeds (median fetch time):")
+        for website, median_time in slowest:
+            size = healths[website]["bytes"]
+            print(f"  {median_time:.2f}s {website} ({size} bytes last time)")
+    failing = [
+        (health["consecutive_failures"], website)
+        for website, health in healths.items()
+        if health.get("consecutive_failures")
+    ]
+    if failing:
+        print("Failing feeds (consecutive failures):")
+        for failures, website in heapq.nlargest(n, failing):
+            health = healths[website]
+            retry_after = health.get("retry_after")
+            print(
+                f"  {failures} {website}: {health['last_error']} "
+                f"(last success: {health.get('last_success')}"
+                f"{f', retrying after {retry_after}' if retry_after else ''})"
+            )
+
+
+def iter_links(state: Dict[str, dict], since: datetime.datetime) -> Iterator[Link]:
+    """
+    Yield the (url, title, date) of the stored entries published after `since`.
+    Dates are stored in ISO format, so they can be compared as strings and only
+    the recent ones need to be converted to datetimes.
+    """
+    since_iso = since.isoformat()
+    for feed_state in state.values():
+        for item in feed_state.get("items", {}).values():
+            if item["date"] is not None and item["date"] >= since_iso:
+                date = datetime.datetime.fromisoformat(item["date"])
+                yield item["url"], item["title"], date
+
+
+def write_html_with_updates(
+    links: Iterable[Link], max_items: Optional[int] = None
+) -> None:
+    if max_items is None:
+        sorted_links = sorted(links, key=lambda x: x[2], reverse=True)
+    else:
+        sorted_links = heapq.nlargest(max_items, links, key=lambda x: x[2])
+
+    # Write to a temporary file first, so a failed build never leaves the page
+    # half written.
+    tmp_path = f"{BLOGROLL_PATH}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write("""---
 layout: default
 # All the Tags of posts.
 ---
@@ -68,38 +339,55 @@ layout: default
     </br>
     <div class="special-list">
     <ul>
-    """
+    """)
 
-    for link, title, date in sorted_links:
-        title = remove_html_tags(title)
-        html += f"""
+        for link, title, date in sorted_links:
+            file.write(f"""
             <li>
             <span class="post-date">{date.date()}</span> -
             <a href='{link}'>{title}</a></li>\n
-        """
+        """)
 
-    html += """
+        file.write("""
     </ul>
     </div>
-    """
-
-    with open("_layouts/blogroll.html", "w") as file:
-        file.write(html)
+    """)
+    os.replace(tmp_path, BLOGROLL_PATH)
 
     print("HTML file with updated links generated.")
 
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--max-items",
+        type=int,
+        default=None,
+        help="Maximum number of posts in the blogroll, the most recent ones.",
+    )
+    parser.add_argument(
+        "--feed-timeout",
+        type=float,
+        default=20,
+        help="Seconds after which a feed that hasn't been downloaded is given up.",
+    )
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
 
     # Read websites from websites.txt
     websites = read_websites("_tools/websites.txt")
 
     # Check for updates
-    entries = []
-    for website in tqdm(websites):
-        feed = feedparser.parse(website)
-        entries += feed.entries
-    write_html_with_updates(entries)
+    state = fetch_feeds(
+        websites, read_feeds_state(FEEDS_STATE_PATH), timeout=args.feed_timeout
+    )
+    write_feeds_state(FEEDS_STATE_PATH, state)
+    report_feeds_health(state)
+    since = datetime.datetime.today() - datetime.timedelta(days=WINDOW_DAYS)
+    write_html_with_updates(iter_links(state, since), args.max_items)
 
 
 if __name__ == "__main__":
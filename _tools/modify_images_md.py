@@ -1,31 +1,154 @@
+import argparse
+import hashlib
+import json
 import os
-import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
+MANIFEST_PATH = "_tools/.images-manifest.json"
+IMAGE_DELIMITERS = ("](", "){: width=", " height=", "}\n_", "_\n\n")
+FIGURE_TEMPLATE = '<figure>\n    <img src="{1}" alt="{0}" width={2} class="center" />\n  <figcaption class="center">{4}</figcaption>\n</figure>\n\n'
 
-def process_md_files(folder_path):
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".md"):
-            file_path = os.path.join(folder_path, filename)
-            process_md_file(file_path)
 
+def read_manifest(filename: str) -> Dict[str, str]:
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as file:
+        return json.load(file)
 
-def process_md_file(file_path):
-    with open(file_path, "r+") as file:
-        content = file.read()
-        modified_content = modify_image_syntax(content)
-        file.seek(0)
-        file.write(modified_content)
-        file.truncate()
 
+def write_manifest(filename: str, manifest: Dict[str, str]) -> None:
+    with open(filename, "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
 
-def modify_image_syntax(content):
-    pattern = r"!\[(.*?)\]\((.*?)\)\{: width=(.*?) height=(.*?)\}\n_(.*?)_\n\n"
-    modified_content = re.sub(pattern, r'<figure>\n    <img src="\2" alt="\1" width=\3 class="center" />\n  <figcaption class="center">\5</figcaption>\n</figure>\n\n', content, flags=re.DOTALL)
-    return modified_content
 
+def process_md_files(
+    folder_path: str,
+    manifest: Optional[Dict[str, str]] = None,
+    write: bool = True,
+    workers: Optional[int] = None,
+) -> List[str]:
+    """
+    Rewrite the image syntax of all the markdown files in `folder_path` and return
+    the ones that changed (or would change, if `write` is False). Files whose hash
+    is in `manifest` are already up to date and aren't processed. The manifest is
+    updated in place with the hashes of the files that are up to date now.
+    """
+    manifest = {} if manifest is None else manifest
+    file_paths = sorted(
+        os.path.join(folder_path, filename)
+        for filename in os.listdir(folder_path)
+        if filename.endswith(".md")
+    )
+    changed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            process_md_file,
+            file_paths,
+            [manifest.get(file_path) for file_path in file_paths],
+            [write] * len(file_paths),
+        )
+        for file_path, (file_changed, digest) in zip(file_paths, results):
+            if file_changed:
+                changed.append(file_path)
+            if digest is not None:
+                manifest[file_path] = digest
+    return changed
 
-# Specify the folder path where your Markdown files are located
-folder_path = "_posts"
 
-# Process the Markdown files in the folder
-process_md_files(folder_path)
+def process_md_file(
+    file_path: str, known_digest: Optional[str] = None, write: bool = True
+) -> Tuple[bool, Optional[str]]:
+    """
+    Rewrite the image syntax of a markdown file. Returns whether the file changed
+    and the hash of its content if it's up to date after the call.
+    """
+    with open(file_path, "rb") as file:
+        raw = file.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    if digest == known_digest:
+        return False, digest
+    content = raw.decode()
+    modified_content = modify_image_syntax(content)
+    if modified_content == content:
+        return False, digest
+    if not write:
+        return True, None
+    modified_raw = modified_content.encode()
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(modified_raw)
+    os.replace(tmp_path, file_path)
+    return True, hashlib.sha256(modified_raw).hexdigest()
+
+
+def modify_image_syntax(content: str) -> str:
+    r"""
+    Replace every `![alt](src){: width=W height=H}\n_caption_\n\n` by a <figure>.
+
+    This gives the same result as substituting the lazy DOTALL regex
+        !\[(.*?)\]\((.*?)\)\{: width=(.*?) height=(.*?)\}\n_(.*?)_\n\n
+    but in linear time, without backtracking. Since the groups can contain anything,
+    the match starting at a "![" ends each group at the first occurrence of the
+    next delimiter. And if some delimiter can't be found after a "![", it can't be
+    found after any later one either, so there's nothing else to replace.
+    """
+    parts = []
+    position = 0
+    while (start := content.find("![", position)) != -1:
+        groups = []
+        end = start + 2
+        for delimiter in IMAGE_DELIMITERS:
+            found = content.find(delimiter, end)
+            if found == -1:
+                parts.append(content[position:])
+                return "".join(parts)
+            groups.append(content[end:found])
+            end = found + len(delimiter)
+        parts.append(content[position:start])
+        parts.append(FIGURE_TEMPLATE.format(*groups))
+        position = end
+    parts.append(content[position:])
+    return "".join(parts)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Replace kramdown images with a caption by <figure> blocks."
+    )
+    # Specify the folder path where your Markdown files are located
+    parser.add_argument("folder_path", nargs="?", default="_posts")
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Don't write anything, exit with an error if some file would change.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Don't write anything, just list the files that would change.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    write = not (args.check or args.dry_run)
+    manifest = read_manifest(args.manifest)
+
+    # Process the Markdown files in the folder
+    changed = process_md_files(args.folder_path, manifest, write, args.workers)
+    if write:
+        write_manifest(args.manifest, manifest)
+
+    for file_path in changed:
+        print(f"{'Modified' if write else 'Would modify'}: {file_path}")
+    if args.check and changed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
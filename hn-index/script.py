@@ -1,58 +1,1061 @@
 import argparse
 import aiohttp
 import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import json
+import os
+import random
+import sqlite3
+import time
 from tqdm import tqdm
 import numpy as np
 
+HN_API_URL = "https://hacker-news.firebaseio.com/v0"
+ALGOLIA_API_URL = "https://hn.algolia.com/api/v1"
+ITEM_FIELDS = ("type", "deleted", "dead", "score", "time")
+CSV_HEADER = "username,number of submissions,h index,karma\n"
+LEADERBOARD_COLUMNS = ("rank", "username", "h_index", "submissions", "karma")
 
-async def fetch_user_data(session, url):
-    async with session.get(url) as response:
-        return await response.json()
 
+class ItemCache:
+    """
+    SQLite store with the fields of the items we need to compute the scores.
+    An item is served from the cache only if it was already older than `max_age`
+    seconds when it was fetched, since by then its score has settled. Younger
+    items are always fetched again, but their cached fields can still be used as
+    hints (see `get_many`).
+    """
+
+    def __init__(self, path, max_age, commit_every=1000):
+        self.max_age = max_age
+        self.commit_every = commit_every
+        self._pending = 0
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY,
+                type TEXT,
+                deleted INTEGER,
+                dead INTEGER,
+                score INTEGER,
+                time INTEGER,
+                fetched_at INTEGER
+            )
+            """)
+
+    def get_many(self, item_ids, settled_only=True, chunk_size=900):
+        """
+        Return the cached items among `item_ids`. With `settled_only=False` items
+        that were fetched while still young are returned too, with a "settled"
+        field telling them apart.
+        """
+        items = {}
+        for i in range(0, len(item_ids), chunk_size):
+            chunk = item_ids[i : i + chunk_size]
+            rows = self._connection.execute(
+                f"""
+                SELECT id, {", ".join(ITEM_FIELDS)},
+                    coalesce(fetched_at - time >= ?, 0) AS settled
+                FROM items
+                WHERE id IN ({", ".join("?" * len(chunk))})
+                """,
+                (self.max_age, *chunk),
+            )
+            for item_id, *values, settled in rows:
+                if settled or not settled_only:
+                    items[item_id] = dict(zip(ITEM_FIELDS, values), settled=settled)
+        return items
+
+    def put(self, item_id, item):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                item_id,
+                item.get("type"),
+                bool(item.get("deleted")),
+                bool(item.get("dead")),
+                item.get("score"),
+                item.get("time"),
+                int(time.time()),
+            ),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self._connection.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._connection.close()
+
+
+def drop_partial_line(path):
+    """
+    Truncate `path` after its last newline, removing a line that was only partially
+    written when the process was killed.
+    """
+    with open(path, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            f.truncate(content.rfind(b"\n") + 1)
+
+
+def append_line(path, line):
+    """Append `line` with a single write, so a kill never leaves half a row."""
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_done_users(output_path):
+    if not os.path.exists(output_path):
+        append_line(output_path, CSV_HEADER)
+        return set()
+    drop_partial_line(output_path)
+    with open(output_path) as f:
+        return {line.split(",")[0] for line in f if line != CSV_HEADER}
+
+
+class ProgressJournal:
+    """
+    Append-only log with a `username,item id,score` line per fetched item, where
+    the score is empty if the item doesn't count for the h-index. It lets a killed
+    run continue half-processed users from the items they already fetched.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            drop_partial_line(path)
+        self._file = open(path, "a", buffering=1)
+
+    def load(self):
+        done = {}
+        with open(self.path) as f:
+            for line in f:
+                username, item_id, score = line.rstrip("\n").split(",")
+                done.setdefault(username, {})[int(item_id)] = (
+                    int(score) if score else None
+                )
+        return done
+
+    def record(self, username, item_id, score):
+        self._file.write(f"{username},{item_id},{'' if score is None else score}\n")
+
+    def close(self):
+        self._file.close()
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of requests in flight. The limit grows by one after
+    `limit` healthy responses, and it's halved after an error or a response slower
+    than `spike_factor` times the moving average latency. Consecutive halvings are
+    spaced by at least one average latency, so a wave of failures only counts once.
+    """
+
+    def __init__(self, initial=50, min_limit=1, max_limit=1000, spike_factor=3.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.spike_factor = spike_factor
+        self.in_flight = 0
+        self.avg_latency = None
+        self._last_decrease = 0.0
+        self._waiters = collections.deque()
+
+    async def __aenter__(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # We were woken up but cancelled before taking the slot, so
+                    # it goes to the next waiter instead.
+                    self._wake_up()
+                raise
+        self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        available = int(self.limit) - self.in_flight
+        while available > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                available -= 1
+
+    def success(self, latency):
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        if latency > self.spike_factor * self.avg_latency:
+            self._decrease()
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+        self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+
+    def failure(self):
+        self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease >= (self.avg_latency or 0):
+            self.limit = max(self.limit / 2, self.min_limit)
+            self._last_decrease = now
+
+
+class Histogram:
+    """Counts of latencies in buckets of doubling size, from 1ms to about a minute."""
+
+    BOUNDS = tuple(0.001 * 2**i for i in range(17))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
 
-async def fetch_item_data(session, url, scores, progress_bar):
-    async with session.get(url) as response:
-        item = await response.json()
-        if (
-            (not item.get("deleted"))
-            and (not item.get("dead"))
-            and (item.get("type") == "story")
-            and (s := item.get("score"))
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile."""
+        rank = q * self.count
+        for bound, cumulative in zip(self.BOUNDS, itertools.accumulate(self.counts)):
+            if cumulative >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": dict(zip(map(str, self.BOUNDS + (float("inf"),)), self.counts)),
+        }
+
+
+# User whose items are being fetched, so the requests can be attributed to them.
+# Tasks inherit it from the task that creates them, like the workers of get_items.
+current_user = contextvars.ContextVar("current_user", default=None)
+
+
+class Stats:
+    """
+    Metrics of a run, enabled with --stats and written as JSON lines to `path`.
+    There's a "user" line when each user finishes, with their wall time and
+    requests, a "snapshot" line every `interval` seconds with the requests in
+    flight, and a "summary" line at the end with the latency histograms and
+    counters, which is also printed.
+
+    The latencies are split in phases: "wait" for the limiter, "pool_wait" for a
+    free connection, "dns", "connect" (DNS, TCP and TLS), "headers" (until the
+    response headers arrive), "body", "decode" (the JSON parsing) and "request"
+    (all of them after the limiter).
+    """
+
+    def __init__(self, path, interval=5.0):
+        self.interval = interval
+        self.start = time.monotonic()
+        self.latencies = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.max_in_flight = 0
+        self.user_times = {}
+        self._user_counters = collections.defaultdict(collections.Counter)
+        self._in_flight_samples = []
+        self._file = open(path, "w", buffering=1)
+
+    def write(self, event, **fields):
+        elapsed = round(time.monotonic() - self.start, 3)
+        self._file.write(
+            json.dumps({"event": event, "elapsed": elapsed, **fields}) + "\n"
+        )
+
+    def record(self, phase, seconds):
+        self.latencies[phase].add(seconds)
+
+    def count(self, name):
+        self.counters[name] += 1
+        if (username := current_user.get()) is not None:
+            self._user_counters[username][name] += 1
+
+    def observe_in_flight(self, in_flight):
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+
+    @contextlib.contextmanager
+    def track_user(self, username):
+        token = current_user.set(username)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            current_user.reset(token)
+            wall_time = time.monotonic() - start
+            counters = self._user_counters.pop(username, {})
+            self.user_times[username] = wall_time
+            # Users served from the cache or a dump can take no measurable time
+            requests_per_second = None
+            if wall_time > 0:
+                requests_per_second = round(counters.get("requests", 0) / wall_time, 1)
+            self.write(
+                "user",
+                username=username,
+                wall_time=round(wall_time, 3),
+                requests_per_second=requests_per_second,
+                **counters,
+            )
+
+    def trace_config(self):
+        """aiohttp hooks timing the connection pool, DNS and connection setup."""
+        trace_config = aiohttp.TraceConfig()
+        for phase, start_signal, end_signal in (
+            (
+                "pool_wait",
+                trace_config.on_connection_queued_start,
+                trace_config.on_connection_queued_end,
+            ),
+            (
+                "dns",
+                trace_config.on_dns_resolvehost_start,
+                trace_config.on_dns_resolvehost_end,
+            ),
+            (
+                "connect",
+                trace_config.on_connection_create_start,
+                trace_config.on_connection_create_end,
+            ),
         ):
-            scores.append(int(s))
-        progress_bar.update(1)
+            start, end = self._phase_hooks(phase)
+            start_signal.append(start)
+            end_signal.append(end)
+
+        async def on_reused_connection(session, context, params):
+            self.count("connections reused")
+
+        async def on_dns_cache_hit(session, context, params):
+            self.count("dns cache hits")
+
+        trace_config.on_connection_reuseconn.append(on_reused_connection)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        return trace_config
+
+    def _phase_hooks(self, phase):
+        async def start(session, context, params):
+            setattr(context, phase, time.monotonic())
+
+        async def end(session, context, params):
+            self.record(phase, time.monotonic() - getattr(context, phase))
+
+        return start, end
+
+    async def monitor(self, limiter, max_connections):
+        """Write a snapshot of the limiter every `interval` seconds."""
+        requests = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            self._in_flight_samples.append(limiter.in_flight)
+            self.write(
+                "snapshot",
+                in_flight=limiter.in_flight,
+                limit=int(limiter.limit),
+                waiting=len(limiter._waiters),
+                pool_utilization=round(limiter.in_flight / max_connections, 3),
+                requests_per_second=round(
+                    (self.counters["requests"] - requests) / self.interval, 1
+                ),
+            )
+            requests = self.counters["requests"]
+
+    def close(self):
+        elapsed = time.monotonic() - self.start
+        samples = self._in_flight_samples
+        slowest = sorted(self.user_times.items(), key=lambda x: x[1], reverse=True)
+        summary = {
+            "wall_time": round(elapsed, 3),
+            "requests_per_second": round(self.counters["requests"] / elapsed, 1),
+            "max_in_flight": self.max_in_flight,
+            "mean_in_flight": sum(samples) / len(samples) if samples else None,
+            "counters": dict(self.counters),
+            "latencies": {
+                phase: histogram.to_dict()
+                for phase, histogram in self.latencies.items()
+            },
+            "slowest_users": dict(slowest[:5]),
+        }
+        self.write("summary", **summary)
+        self._file.close()
+
+        print(
+            f"{self.counters['requests']} requests in {elapsed:.1f}s "
+            f"({summary['requests_per_second']} req/s), "
+            f"{self.counters['retries']} retries, "
+            f"max {self.max_in_flight} in flight"
+        )
+        for name, value in sorted(self.counters.items()):
+            if name.startswith("error"):
+                print(f"  {name}: {value}")
+        for phase, histogram in sorted(self.latencies.items()):
+            print(
+                f"  {phase:>9}: n={histogram.count} "
+                f"mean={histogram.total / histogram.count * 1000:.1f}ms "
+                f"p50<={histogram.quantile(0.5) * 1000:g}ms "
+                f"p99<={histogram.quantile(0.99) * 1000:g}ms "
+                f"max={histogram.max * 1000:.1f}ms"
+            )
+        for username, wall_time in slowest[:5]:
+            print(f"  {username}: {wall_time:.1f}s")
+
+
+class JSONClient:
+    """
+    Requests to a JSON API, throttled by an `AdaptiveLimiter`. Failed requests
+    (connection errors, timeouts, 429s, 5xxs...) are retried up to `retries` times
+    with jittered exponential backoff.
+    """
+
+    def __init__(self, session, limiter, retries=5, backoff=0.5, stats=None):
+        self.session = session
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = stats
+
+    async def fetch_json(self, url, params=None):
+        stats = self.stats
+        for attempt in range(self.retries + 1):
+            if stats is not None:
+                stats.count("requests")
+                if attempt:
+                    stats.count("retries")
+                queued = time.monotonic()
+            async with self.limiter:
+                start = time.monotonic()
+                if stats is not None:
+                    stats.record("wait", start - queued)
+                    stats.observe_in_flight(self.limiter.in_flight)
+                try:
+                    async with self.session.get(url, params=params) as response:
+                        headers = time.monotonic()
+                        response.raise_for_status()
+                        body = await response.read()
+                    received = time.monotonic()
+                    data = json.loads(body)
+                    self.limiter.success(received - start)
+                    if stats is not None:
+                        stats.record("headers", headers - start)
+                        stats.record("body", received - headers)
+                        stats.record("decode", time.monotonic() - received)
+                        stats.record("request", time.monotonic() - start)
+                    return data
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    self.limiter.failure()
+                    if stats is not None:
+                        stats.count(f"errors {getattr(e, 'status', type(e).__name__)}")
+                    if attempt == self.retries:
+                        raise
+            await asyncio.sleep(random.uniform(0, self.backoff * 2**attempt))
+
+
+class FirebaseBackend:
+    """Users and items fetched one by one from the HN Firebase API."""
+
+    def __init__(self, client, workers=100):
+        self.client = client
+        self.workers = workers
+
+    async def get_user(self, username):
+        return await self.client.fetch_json(f"{HN_API_URL}/user/{username}.json")
+
+    async def get_item(self, item_id):
+        return await self.client.fetch_json(f"{HN_API_URL}/item/{item_id}.json") or {}
+
+    async def get_items(self, user, item_ids):
+        """
+        Yield `(item id, item)` pairs as they arrive, with `None` for the items
+        that couldn't be fetched. The ids are streamed through a bounded queue to
+        a fixed pool of workers, so the memory used doesn't grow with the number
+        of items. Any other error of a worker is raised here. Closing the
+        generator cancels the pending requests.
+        """
+        ids = asyncio.Queue(maxsize=2 * self.workers)
+        results = asyncio.Queue(maxsize=2 * self.workers)
+
+        async def produce():
+            for item_id in item_ids:
+                await ids.put(item_id)
+            for _ in range(self.workers):
+                await ids.put(None)
+
+        async def work():
+            try:
+                while (item_id := await ids.get()) is not None:
+                    try:
+                        item = await self.get_item(item_id)
+                    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                        item = None
+                    await results.put((item_id, item))
+            except Exception as e:
+                # Handed to the consumer so it doesn't wait for this worker forever
+                await results.put(e)
+            else:
+                await results.put(None)
 
+        tasks = [asyncio.create_task(produce())]
+        tasks += [asyncio.create_task(work()) for _ in range(self.workers)]
+        try:
+            running = self.workers
+            while running:
+                if (result := await results.get()) is None:
+                    running -= 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-async def get_user_scores(username):
-    user_url = (
-        f"https://hacker-news.firebaseio.com/v0/user/{username}.json?print=pretty"
+
+class AlgoliaBackend:
+    """
+    Stories fetched in bulk from the HN Search API, up to 1000 per request.
+    Algolia only indexes live stories, so the submissions of a user are just their
+    stories, and its scores can lag a bit behind Firebase.
+    """
+
+    def __init__(self, client, page_size=1000):
+        self.client = client
+        self.page_size = page_size
+
+    async def get_user(self, username):
+        user = await self.client.fetch_json(f"{ALGOLIA_API_URL}/users/{username}")
+        stories = {}
+        params = {"tags": f"story,author_{username}", "hitsPerPage": self.page_size}
+        while True:
+            page = await self.client.fetch_json(
+                f"{ALGOLIA_API_URL}/search_by_date", params=params
+            )
+            new_hits = [
+                hit for hit in page["hits"] if int(hit["objectID"]) not in stories
+            ]
+            for hit in new_hits:
+                stories[int(hit["objectID"])] = {
+                    "type": "story",
+                    "score": hit["points"],
+                    "time": hit["created_at_i"],
+                }
+            if not new_hits or len(page["hits"]) < self.page_size:
+                break
+            # search_by_date returns the newest stories first, so the next page
+            # is made of the ones posted before the oldest story in this one.
+            params["numericFilters"] = f"created_at_i<={new_hits[-1]['created_at_i']}"
+        # The stories travel with the user, so they're dropped along with it
+        return {"karma": user["karma"], "submitted": list(stories), "stories": stories}
+
+    async def get_items(self, user, item_ids):
+        for item_id in item_ids:
+            yield item_id, user["stories"].get(item_id, {})
+
+
+class DumpBackend:
+    """
+    Users and items read from a local JSON-lines dump with one Firebase user or
+    item object per line. Users without a record in the dump are built from the
+    items they authored.
+    """
+
+    def __init__(self, path):
+        self.users = {}
+        self.items = {}
+        authored = collections.defaultdict(list)
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if "karma" in record:
+                    self.users[record["id"]] = record
+                else:
+                    self.items[record["id"]] = {
+                        field: record.get(field) for field in ITEM_FIELDS
+                    }
+                    if "by" in record:
+                        authored[record["by"]].append(record["id"])
+        for username, item_ids in authored.items():
+            user = self.users.setdefault(username, {"id": username, "karma": None})
+            user.setdefault("submitted", sorted(item_ids, reverse=True))
+
+    async def get_user(self, username):
+        # None for unknown users, as Firebase answers
+        return self.users.get(username)
+
+    async def get_items(self, user, item_ids):
+        for item_id in item_ids:
+            yield item_id, self.items.get(item_id, {})
+
+
+@contextlib.asynccontextmanager
+async def open_backend(
+    name="firebase",
+    max_connections=1000,
+    retries=5,
+    workers=100,
+    dump_path=None,
+    stats=None,
+):
+    if name == "dump":
+        yield DumpBackend(dump_path)
+        return
+    connector = aiohttp.TCPConnector(limit=max_connections)
+    timeout = aiohttp.ClientTimeout(total=30)
+    trace_configs = [stats.trace_config()] if stats is not None else None
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout, trace_configs=trace_configs
+    ) as session:
+        limiter = AdaptiveLimiter(
+            initial=min(50, max_connections), max_limit=max_connections
+        )
+        client = JSONClient(session, limiter, retries, stats=stats)
+        if stats is not None:
+            monitor = asyncio.create_task(stats.monitor(limiter, max_connections))
+        try:
+            if name == "algolia":
+                yield AlgoliaBackend(client)
+            else:
+                yield FirebaseBackend(client, workers)
+        finally:
+            if stats is not None:
+                monitor.cancel()
+
+
+def get_score(item):
+    if (
+        (not item.get("deleted"))
+        and (not item.get("dead"))
+        and (item.get("type") == "story")
+        and (s := item.get("score"))
+    ):
+        return int(s)
+    return None
+
+
+class HIndex:
+    """
+    Online h-index. The scores greater than the current h-index are kept in a
+    min-heap, which never holds more than h of them, so adding a score costs
+    O(log h) and the memory is O(h).
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.n_scores = 0
+        self._above = []
+
+    def add(self, score):
+        """Add a score and return whether the h-index increased."""
+        self.n_scores += 1
+        if score <= self.value:
+            return False
+        heapq.heappush(self._above, score)
+        if len(self._above) <= self.value:
+            return False
+        self.value += 1
+        while self._above and self._above[0] <= self.value:
+            heapq.heappop(self._above)
+        return True
+
+    def is_final(self, remaining):
+        """Whether `remaining` more scores can't increase the h-index anymore."""
+        return len(self._above) + remaining <= self.value
+
+
+class UserNotFound(LookupError):
+    """The backend doesn't know the user."""
+
+
+async def get_user_scores(
+    backend, username, cache=None, journal=None, done=None, h_index_only=False
+):
+    """
+    Return the karma of `username`, the `HIndex` of the scores of their stories
+    and the ids of the items that couldn't be fetched. Items already in `done`
+    (item id to score) are not fetched again, and newly fetched items are recorded
+    in `journal`.
+
+    With `h_index_only` the fetching stops as soon as the remaining items can't
+    change the h-index, so the number of stories is only a lower bound. Items the
+    cache knows aren't stories are skipped, and the ones it knows are stories are
+    fetched first, from the highest cached score to the lowest. Without a cache
+    the items are fetched in the order of `user["submitted"]`, so at most the
+    last h-index of them are skipped.
+
+    Raise `UserNotFound` if the backend has no such user. Users without
+    submissions have no `submitted` field.
+    """
+    user = await backend.get_user(username)
+    if user is None:
+        raise UserNotFound(username)
+    submitted = user.get("submitted", [])
+
+    done = dict(done or {})
+    priority = []
+    if cache is not None:
+        pending = [item_id for item_id in submitted if item_id not in done]
+        cached = cache.get_many(pending, settled_only=not h_index_only)
+        for item_id, item in cached.items():
+            if item["settled"] or item["type"] != "story":
+                done[item_id] = get_score(item)
+            else:
+                priority.append((item["score"] or 0, item_id))
+    priority = [item_id for _, item_id in sorted(priority, reverse=True)]
+    prioritized = set(priority)
+    item_ids = itertools.chain(
+        priority,
+        (
+            item_id
+            for item_id in submitted
+            if item_id not in done and item_id not in prioritized
+        ),
     )
-    connector = aiohttp.TCPConnector(limit=1000)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        user = await fetch_user_data(session, user_url)
 
-        item_urls = [
-            f"https://hacker-news.firebaseio.com/v0/item/{sub}.json"
-            for sub in user["submitted"]
-        ]
+    scores = HIndex()
+    for score in done.values():
+        if score is not None:
+            scores.add(score)
+    failed = []
+    remaining = len(submitted) - len(done)
+
+    with tqdm(
+        total=len(submitted),
+        initial=len(done),
+        desc=f"Fetching {username}'s scores",
+        leave=False,
+    ) as pbar:
+        pbar.set_postfix(h_index=scores.value, refresh=False)
+        if h_index_only and scores.is_final(remaining):
+            return user["karma"], scores, failed
+        async with contextlib.aclosing(backend.get_items(user, item_ids)) as items:
+            async for item_id, item in items:
+                if item is None:
+                    failed.append(item_id)
+                    continue
+                remaining -= 1
+                score = get_score(item)
+                if score is not None and scores.add(score):
+                    pbar.set_postfix(h_index=scores.value, refresh=False)
+                if cache is not None:
+                    cache.put(item_id, item)
+                if journal is not None:
+                    journal.record(username, item_id, score)
+                pbar.update(1)
+                if h_index_only and scores.is_final(remaining):
+                    break
+
+    return user["karma"], scores, failed
+
+
+async def get_single_user_scores(
+    backend, username, h_index_only, cache=None, stats=None
+):
+    async with backend as opened_backend:
+        with stats.track_user(username) if stats else contextlib.nullcontext():
+            return await get_user_scores(
+                opened_backend, username, cache, h_index_only=h_index_only
+            )
+
 
-        scores = []
-        with tqdm(total=len(item_urls), desc=f"Fetching {username}'s scores") as pbar:
-            tasks = [fetch_item_data(session, url, scores, pbar) for url in item_urls]
-            await asyncio.gather(*tasks)
+async def get_users_scores(
+    backend,
+    usernames,
+    output_path,
+    journal_path,
+    max_users,
+    h_index_only,
+    cache=None,
+    stats=None,
+):
+    """
+    Compute the scores of all the users sharing a single event loop and a single
+    backend, so they also share its pooled session. At most `max_users` users are
+    processed at the same time, and their rows are appended to `output_path` as
+    soon as each one finishes.
+
+    Users already in `output_path` are skipped, and users that were half-processed
+    by a previous run continue from the items recorded in the journal. Users with
+    items that failed after all the retries are reported and left out of the csv,
+    so running again completes them. The journal is removed once every user is done.
+    Users the backend doesn't know are reported and left out too.
+    """
+    done_users = read_done_users(output_path)
+    usernames = [username for username in usernames if username not in done_users]
+    journal = ProgressJournal(journal_path)
+    done_items = journal.load()
+    semaphore = asyncio.Semaphore(max_users)
+    incomplete = []
+
+    async with backend as opened_backend:
+
+        async def process_user(username):
+            async with semaphore:
+                try:
+                    with (
+                        stats.track_user(username)
+                        if stats
+                        else contextlib.nullcontext()
+                    ):
+                        karma, scores, failed = await get_user_scores(
+                            opened_backend,
+                            username,
+                            cache,
+                            journal,
+                            done_items.get(username),
+                            h_index_only,
+                        )
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    tqdm.write(f"Couldn't fetch {username}: {e!r}")
+                    incomplete.append(username)
+                    return
+                except UserNotFound:
+                    # Running again won't help, so they don't make the run incomplete
+                    tqdm.write(f"Couldn't find {username}")
+                    return
+            if failed:
+                tqdm.write(f"Couldn't fetch {len(failed)} items of {username}")
+                incomplete.append(username)
+                return
+            append_line(
+                output_path,
+                f"{username},{scores.n_scores},{scores.value},{karma}\n",
+            )
 
-    return user["karma"], scores
+        try:
+            with tqdm(total=len(usernames), desc="Users") as pbar:
+                for result in asyncio.as_completed(
+                    [process_user(username) for username in usernames]
+                ):
+                    await result
+                    pbar.update(1)
+        finally:
+            journal.close()
+    if incomplete:
+        print(f"{len(incomplete)} users are incomplete, run again to finish them.")
+    else:
+        os.remove(journal_path)
 
 
 def h_index(scores):
-    return sum(x >= i + 1 for i, x in enumerate(sorted(list(scores), reverse=True)))
+    index = HIndex()
+    for score in scores:
+        index.add(score)
+    return index.value
+
+
+def read_leaderboard(output_path):
+    """
+    Rows of `output_path` sorted by h-index, then karma and then username, with
+    their rank. Users with the same h-index share the same rank.
+    """
+    rows = {}
+    with open(output_path) as f:
+        for line in f:
+            if line == CSV_HEADER:
+                continue
+            username, submissions, h, karma = line.rstrip("\n").split(",")
+            rows[username] = {
+                "username": username,
+                "h_index": int(h),
+                "submissions": int(submissions),
+                "karma": int(karma) if karma.isdigit() else None,
+            }
+    leaderboard = sorted(
+        rows.values(), key=lambda r: (-r["h_index"], -(r["karma"] or 0), r["username"])
+    )
+    for position, row in enumerate(leaderboard):
+        if position and row["h_index"] == leaderboard[position - 1]["h_index"]:
+            row["rank"] = leaderboard[position - 1]["rank"]
+        else:
+            row["rank"] = position + 1
+    return leaderboard
+
+
+def write_json(path, data):
+    """Write `data` compactly to `path`, atomically."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def export_leaderboard(output_path, export_dir, shard_size=1000, prefix_length=2):
+    """
+    Write the users of `output_path` as a ranked leaderboard to `export_dir`, so a
+    page can load the top of it without downloading the whole csv.
+
+    The leaderboard is split in shards of `shard_size` users, `shard-N.json`,
+    each one with a list per column of `LEADERBOARD_COLUMNS`, which compresses
+    well. `index.json` has the number of users, the rank and h-index range of each
+    shard, and the shards holding the usernames starting with each lowercase
+    prefix of `prefix_length` characters, to find a user fetching a single shard.
+    It's written after the shards, so it never points to missing ones.
+    """
+    leaderboard = read_leaderboard(output_path)
+    os.makedirs(export_dir, exist_ok=True)
+    shards = []
+    prefixes = collections.defaultdict(set)
+    for number, first in enumerate(range(0, len(leaderboard), shard_size)):
+        rows = leaderboard[first : first + shard_size]
+        name = f"shard-{number}.json"
+        write_json(
+            os.path.join(export_dir, name),
+            {column: [row[column] for row in rows] for column in LEADERBOARD_COLUMNS},
+        )
+        shards.append(
+            {
+                "file": name,
+                "ranks": [rows[0]["rank"], rows[-1]["rank"]],
+                "h_index": [rows[0]["h_index"], rows[-1]["h_index"]],
+                "users": len(rows),
+            }
+        )
+        for row in rows:
+            prefixes[row["username"][:prefix_length].lower()].add(number)
+    write_json(
+        os.path.join(export_dir, "index.json"),
+        {
+            "users": len(leaderboard),
+            "shard_size": shard_size,
+            "columns": LEADERBOARD_COLUMNS,
+            "shards": shards,
+            "prefixes": {
+                prefix: sorted(numbers) for prefix, numbers in sorted(prefixes.items())
+            },
+        },
+    )
+    # Remove the shards left by a previous, longer leaderboard
+    number = len(shards)
+    while os.path.exists(stale := os.path.join(export_dir, f"shard-{number}.json")):
+        os.remove(stale)
+        number += 1
+    return len(leaderboard), len(shards)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--user", default=None)
     parser.add_argument("--users-path", default=None)
-    return parser.parse_args()
+    parser.add_argument(
+        "--backend",
+        choices=["firebase", "algolia", "dump"],
+        default="firebase",
+        help=(
+            "Where the items come from: the Firebase API one item at a time, the "
+            "Algolia search API in bulk, or a local JSON-lines dump (--dump-path)."
+        ),
+    )
+    parser.add_argument(
+        "--dump-path",
+        default=None,
+        help="JSON-lines file with one HN user or item per line.",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=1000,
+        help="Maximum number of open connections shared by all the users.",
+    )
+    parser.add_argument(
+        "--max-users",
+        type=int,
+        default=4,
+        help="Maximum number of users processed at the same time in batch mode.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=100,
+        help="Number of workers fetching the items of each user.",
+    )
+    parser.add_argument(
+        "--h-index-only",
+        action="store_true",
+        help=(
+            "Stop fetching items once the h-index can't change, so the number of "
+            "submissions is only a lower bound. It only saves much with a warm "
+            "--cache-path: otherwise the items are fetched newest first and at "
+            "most the last h-index of them are skipped."
+        ),
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Number of times a failed request is retried before giving up.",
+    )
+    parser.add_argument(
+        "--cache-path",
+        default=None,
+        help="SQLite file where fetched items are cached between runs.",
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=7,
+        help="Age in days after which an item's score is considered final.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help=(
+            "Write latency histograms, counters and per-user timings to a "
+            "USER-stats.jsonl or USERS-stats.jsonl file, and print a summary."
+        ),
+    )
+    parser.add_argument(
+        "--export-dir",
+        default=None,
+        help=(
+            "Directory where the users in the output csv are written as a ranked "
+            "leaderboard split in JSON shards. Requires --users-path."
+        ),
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=1000,
+        help="Number of users in each shard of the exported leaderboard.",
+    )
+    args = parser.parse_args()
+    if args.export_dir and not args.users_path:
+        parser.error("--export-dir requires --users-path")
+    if args.stats and not (args.user or args.users_path):
+        parser.error("--stats requires --user or --users-path")
+    if args.backend == "dump" and not args.dump_path:
+        parser.error("--backend dump requires --dump-path")
+    return args
 
 
 def main():
@@ -68,25 +1071,102 @@ def main():
         where USERS is a file with a username per line.
         The result of this script is a csv file with columns
             username,number of submissions,h index,karma
+        All the users share the same connection pool, and up to --max-users of them
+        are processed concurrently. Rows are written as soon as each user finishes,
+        so they might not follow the order of the users file.
         Notice that firebase can kill your connection if you make too many requests.
-        If your users file is too big you might need to resume the process manually from time to time.
-        The csv is generated one line at a time, so you'll only need to resume the process with unprocessed users.
+        Requests are throttled adaptively and retried, but some of them can still fail.
+        If that happens just run the same command again. Users already in the csv are
+        skipped, and users that were being processed continue from the items stored
+        in the USERS-journal.csv file, which is deleted once all the users are done.
+
+    By default the items are fetched one by one from the Firebase API. With
+    --backend algolia the stories of each user are fetched in bulk from the HN
+    search API instead, and with --backend dump --dump-path DUMP they're read from
+    a local JSON-lines file, which is handy to test and benchmark offline.
+
+    In both modes you can pass --h-index-only to stop fetching the items of a user
+    as soon as their h-index can't change anymore. In that case the number of
+    submissions is only a lower bound. The saving depends on a warm --cache-path,
+    which lets the stories with the highest known scores be fetched first and the
+    items known not to be stories be skipped. Without it the items are fetched
+    newest first, and at most the last h-index of them are skipped.
+
+    In both modes you can also pass --cache-path to keep the fetched items in a local
+    SQLite file. Items that were older than --cache-max-age days when they were
+    fetched are read from it in later runs instead of being requested again.
+
+    With --stats the requests are timed by phase (waiting for the limiter and
+    the connection pool, DNS, connecting, headers, body, JSON decoding), and the
+    retries, errors and wall time per user are counted. They're written as JSON
+    lines to USER-stats.jsonl or USERS-stats.jsonl, and summarized at the end.
+
+    In batch mode you can pass --export-dir DIR to write the csv, once the users
+    are processed, as a leaderboard sorted by h-index and split in JSON shards of
+    --shard-size users, with an index.json to find them (see export_leaderboard).
+    Users already in the csv are skipped, so running again just exports it.
     """
     args = parse_args()
-    if username := args.user:
-        karma, scores_result = asyncio.run(get_user_scores(username))
-        print(username, karma, h_index(scores_result))
-    if users_path := args.users_path:
-        output_path = f"{users_path.split('.')[0]}-output.csv"
-
-        with open(users_path) as f:
-            for username in f.readlines():
-                username = username.strip("\n")
-                karma, scores_result = asyncio.run(get_user_scores(username))
-                with open(output_path, "a+") as f:
-                    f.write(
-                        f"{username},{len(scores_result)},{h_index(scores_result)},{karma}\n"
+    stats = None
+    if args.stats:
+        stats = Stats(f"{(args.users_path or args.user).split('.')[0]}-stats.jsonl")
+    # A backend can only be opened once, so each mode gets its own
+    make_backend = functools.partial(
+        open_backend,
+        args.backend,
+        args.max_connections,
+        args.retries,
+        args.workers,
+        args.dump_path,
+        stats,
+    )
+    cache = None
+    if args.cache_path:
+        cache = ItemCache(args.cache_path, max_age=args.cache_max_age * 24 * 3600)
+    try:
+        if username := args.user:
+            try:
+                karma, scores_result, failed = asyncio.run(
+                    get_single_user_scores(
+                        make_backend(), username, args.h_index_only, cache, stats
                     )
+                )
+            except UserNotFound:
+                print(f"Couldn't find {username}")
+            else:
+                print(username, karma, scores_result.value)
+                if failed:
+                    print(
+                        f"Couldn't fetch {len(failed)} items, the h-index might be low."
+                    )
+        if users_path := args.users_path:
+            output_path = f"{users_path.split('.')[0]}-output.csv"
+            journal_path = f"{users_path.split('.')[0]}-journal.csv"
+
+            with open(users_path) as f:
+                usernames = [line.strip("\n") for line in f if line.strip()]
+            asyncio.run(
+                get_users_scores(
+                    make_backend(),
+                    usernames,
+                    output_path,
+                    journal_path,
+                    args.max_users,
+                    args.h_index_only,
+                    cache,
+                    stats,
+                )
+            )
+            if args.export_dir:
+                n_users, n_shards = export_leaderboard(
+                    output_path, args.export_dir, args.shard_size
+                )
+                print(f"Exported {n_users} users in {n_shards} shards.")
+    finally:
+        if cache is not None:
+            cache.close()
+        if stats is not None:
+            stats.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,246 @@
+"""
+Local stand-in for the HN Firebase and Algolia APIs that injects failures, to
+run script.py without hitting the real services.
+
+    > python stand_in_server.py --port 8080 --failure-rate 0.3
+
+serves made-up users and items, answering a fraction of the requests with a 429,
+a 500 or a truncated JSON body. Point HN_API_URL and ALGOLIA_API_URL of script.py
+to http://localhost:8080/v0 and http://localhost:8080/api/v1 to use it.
+
+    > python stand_in_server.py --check
+
+starts the server in the background and runs the batch mode of script.py
+against it with the Firebase and Algolia backends, with and without
+--h-index-only, checking that each run finishes in time and that the h-indexes
+match the ones of the data.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+
+from aiohttp import web
+
+import script
+
+USERNAMES = ("alice", "bob", "carol", "dave")
+
+
+def make_data(usernames=USERNAMES, n_items=300, seed=0):
+    """Users in the Firebase format and their items, a third of them stories."""
+    rng = random.Random(seed)
+    users, items = {}, {}
+    for username in usernames:
+        submitted = []
+        for _ in range(n_items):
+            item_id = len(items) + 1
+            item_type = rng.choice(["story", "comment", "comment"])
+            items[item_id] = {
+                "id": item_id,
+                "by": username,
+                "type": item_type,
+                "time": 1_600_000_000 + item_id,
+            }
+            if item_type == "story":
+                items[item_id]["score"] = rng.randint(1, 400)
+            if rng.random() < 0.05:
+                items[item_id]["dead"] = True
+            submitted.append(item_id)
+        users[username] = {
+            "id": username,
+            "karma": rng.randint(1, 10000),
+            "submitted": submitted[::-1],
+        }
+    return users, items
+
+
+def make_app(users, items, failure_rate=0.0, delay=0.002, seed=0):
+    rng = random.Random(seed)
+
+    @web.middleware
+    async def inject_failures(request, handler):
+        await asyncio.sleep(delay)
+        if rng.random() < failure_rate:
+            failure = rng.choice([429, 500, "truncated"])
+            if failure == "truncated":
+                return web.Response(text='{"id": ', content_type="application/json")
+            return web.Response(status=failure)
+        return await handler(request)
+
+    async def get_user(request):
+        return web.json_response(users[request.match_info["username"]])
+
+    async def get_item(request):
+        return web.json_response(items[int(request.match_info["item_id"])])
+
+    async def get_algolia_user(request):
+        user = users[request.match_info["username"]]
+        return web.json_response({"username": user["id"], "karma": user["karma"]})
+
+    async def search_by_date(request):
+        username = request.query["tags"].split("author_")[1]
+        stories = [
+            items[item_id]
+            for item_id in users[username]["submitted"]
+            if items[item_id]["type"] == "story" and not items[item_id].get("dead")
+        ]
+        if numeric_filters := request.query.get("numericFilters"):
+            before = int(numeric_filters.split("<=")[1])
+            stories = [story for story in stories if story["time"] <= before]
+        stories.sort(key=lambda story: story["time"], reverse=True)
+        hits = [
+            {
+                "objectID": str(story["id"]),
+                "points": story["score"],
+                "created_at_i": story["time"],
+            }
+            for story in stories[: int(request.query["hitsPerPage"])]
+        ]
+        return web.json_response({"hits": hits})
+
+    app = web.Application(middlewares=[inject_failures])
+    app.router.add_get("/v0/user/{username}.json", get_user)
+    app.router.add_get("/v0/item/{item_id}.json", get_item)
+    app.router.add_get("/api/v1/users/{username}", get_algolia_user)
+    app.router.add_get("/api/v1/search_by_date", search_by_date)
+    return app
+
+
+def expected_rows(users, items):
+    """Username to `(number of stories, h-index, karma)` of the data."""
+    rows = {}
+    for username, user in users.items():
+        scores = [
+            score
+            for item_id in user["submitted"]
+            if (score := script.get_score(items[item_id])) is not None
+        ]
+        rows[username] = (len(scores), script.h_index(scores), user["karma"])
+    return rows
+
+
+async def run_batch(backend, usernames, directory, h_index_only, timeout, max_runs):
+    """
+    Run the batch mode of script.py in `directory` until no user is incomplete,
+    as the script suggests, and return the rows of the csv by username and the
+    problems found.
+    """
+    output_path = os.path.join(directory, "users-output.csv")
+    journal_path = os.path.join(directory, "users-journal.csv")
+    errors = []
+    for _ in range(max_runs):
+        try:
+            await asyncio.wait_for(
+                script.get_users_scores(
+                    script.open_backend(backend),
+                    usernames,
+                    output_path,
+                    journal_path,
+                    max_users=len(usernames),
+                    h_index_only=h_index_only,
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            errors.append(f"didn't finish in {timeout}s")
+            break
+        if not os.path.exists(journal_path):
+            break
+    else:
+        errors.append(f"incomplete after {max_runs} runs")
+    rows = {}
+    if os.path.exists(output_path):
+        for row in script.read_leaderboard(output_path):
+            rows[row["username"]] = (row["submissions"], row["h_index"], row["karma"])
+    return rows, errors
+
+
+async def check(failure_rate, delay, timeout, max_runs):
+    """
+    Run the batch mode against a stand-in server with the Firebase and Algolia
+    backends, with and without `h_index_only`, and return the problems found.
+    """
+    users, items = make_data()
+    expected = expected_rows(users, items)
+    runner = web.AppRunner(make_app(users, items, failure_rate, delay))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    port = runner.addresses[0][1]
+    script.HN_API_URL = f"http://127.0.0.1:{port}/v0"
+    script.ALGOLIA_API_URL = f"http://127.0.0.1:{port}/api/v1"
+    errors = []
+    try:
+        for backend in ("firebase", "algolia"):
+            for h_index_only in (False, True):
+                name = f"{backend}{' --h-index-only' if h_index_only else ''}"
+                with tempfile.TemporaryDirectory() as directory:
+                    rows, run_errors = await run_batch(
+                        backend, list(users), directory, h_index_only, timeout, max_runs
+                    )
+                errors += [f"{name}: {error}" for error in run_errors]
+                for username, row in expected.items():
+                    got = rows.get(username)
+                    # With h_index_only the number of stories is a lower bound
+                    if (
+                        got is None
+                        or got[1:] != row[1:]
+                        or (not h_index_only and got[0] != row[0])
+                    ):
+                        errors.append(f"{name}: {username} got {got}, expected {row}")
+    finally:
+        await runner.cleanup()
+    return errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.3,
+        help="Fraction of the requests answered with a 429, a 500 or broken JSON.",
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=0.002,
+        help="Seconds every request takes.",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Run script.py against the server instead of just serving.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        help="Seconds a run of script.py can take before --check fails.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.check:
+        errors = asyncio.run(
+            check(args.failure_rate, args.delay, args.timeout, max_runs=5)
+        )
+        for error in errors:
+            print(error)
+        print("FAILED" if errors else "OK")
+        raise SystemExit(1 if errors else 0)
+    users, items = make_data()
+    web.run_app(
+        make_app(users, items, args.failure_rate, args.delay),
+        host="127.0.0.1",
+        port=args.port,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing import Optional, Sequence
+from typing import Optional, Sequence, Union
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -6,17 +6,19 @@ import pandas as pd
 import plotly.express as px
 import plotly.io as pio
 
+from utils import RatingsIndex, as_ratings_index
 
-def plot_histograms(data: pd.DataFrame, country: Optional[str] = None):
-    if country:
-        senior = data[(data["country"] == country)].copy()
-    else:
-        senior = data.copy()
-    male = senior[(senior["sex"] == "M")].sort_values("rating")["rating"]
-    female = senior[(senior["sex"] == "F")].sort_values("rating")["rating"]
-    print(f"male {np.mean(male):.2f} +- {np.std(male):.2f}")
-    print(f"female {np.mean(female):.2f} +- {np.std(female):.2f}")
-    print(f"best diff: {max(male) - max(female)}")
+
+def plot_histograms(
+    data: Union[pd.DataFrame, RatingsIndex], country: Optional[str] = None
+):
+    index = as_ratings_index(data)
+    country = country or None
+    male = index.get(country, "M")
+    female = index.get(country, "F")
+    print(f"male {index.mean(country, 'M'):.2f} +- {index.std(country, 'M'):.2f}")
+    print(f"female {index.mean(country, 'F'):.2f} +- {index.std(country, 'F'):.2f}")
+    print(f"best diff: {male[-1] - female[-1]}")
     bins = np.linspace(800, 2800, 37)
     plt.hist(
         male,
@@ -63,7 +65,7 @@ def plot_bilalic_vs_blom(ks: Sequence[int], comparison: dict):
         ks, comparison["bilalic"], "o", markersize=3, label="Bilalic approximation"
     )
     plt.plot(ks, comparison["blom"], "s", markersize=3, label="Blom approximation")
-    plt.plot(ks, comparison["numeric"], "r", label="Numeric experiments")
+    plt.plot(ks, comparison["numeric"], "r", label="Numerical integration")
     plt.fill_between(
         ks,
         comparison["numeric"] - comparison["numeric std"],
@@ -1,71 +1,574 @@
-from math import log
-from typing import List, Optional, Sequence, Tuple
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import pandas as pd
-from scipy.special import ndtri
+from scipy.special import gammaln, log_ndtr, ndtri
 from scipy.stats import norm
 from tqdm import tqdm
 
 
+class RatingsIndex:
+    """
+    Ratings of the players grouped by country and sex, built once so that the
+    analyses don't have to filter and sort a DataFrame on every call.
+
+    All the ratings are stored in a single array, grouped by country and, within
+    each country, men first. Each group is sorted in ascending order, and the one of
+    the i-th country and the j-th sex is `ratings[offsets[2 * i + j]:offsets[2 * i + j + 1]]`.
+    """
+
+    SEXES = ("M", "F")
+
+    def __init__(self, countries: np.ndarray, ratings: np.ndarray, offsets: np.ndarray):
+        self.countries = countries
+        self.ratings = ratings
+        self.offsets = offsets
+        self._country_codes = {country: i for i, country in enumerate(countries)}
+        self._cache: Dict[tuple, np.ndarray] = {}
+        self._moments: Dict[tuple, Tuple[int, float, float]] = {}
+
+    @classmethod
+    def from_codes(
+        cls,
+        countries: Sequence[str],
+        country_codes: np.ndarray,
+        sex_codes: np.ndarray,
+        ratings: np.ndarray,
+    ) -> "RatingsIndex":
+        """
+        Build the index from the country of each player, as an index in
+        `countries`, and their sex, as an index in `SEXES`.
+        """
+        groups = 2 * country_codes.astype(np.int64) + sex_codes
+        order = np.lexsort((ratings, groups))
+        offsets = np.searchsorted(groups[order], np.arange(2 * len(countries) + 1))
+        return cls(np.asarray(countries, dtype=str), ratings[order], offsets)
+
+    @classmethod
+    def from_dataframe(cls, data: pd.DataFrame) -> "RatingsIndex":
+        """
+        Build the index from a DataFrame with country, sex and rating columns.
+        Players whose sex isn't one of `SEXES` are left out.
+        """
+        data = data[data["sex"].isin(cls.SEXES)]
+        countries = pd.Categorical(data["country"])
+        return cls.from_codes(
+            countries.categories,
+            countries.codes,
+            (data["sex"] == "F").to_numpy(),
+            data["rating"].to_numpy(),
+        )
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        for name in ("countries", "ratings", "offsets"):
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: Optional[str] = "r") -> "RatingsIndex":
+        """Load an index saved with `save`, memory-mapping it by default."""
+        return cls(
+            *(
+                np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                for name in ("countries", "ratings", "offsets")
+            )
+        )
+
+    def span(self, country: Optional[str] = None, sex: Optional[str] = None):
+        """
+        Start and end in `ratings` of the players of `country` and `sex`. All the
+        countries together are only contiguous if `sex` is None as well.
+        """
+        if country is None:
+            if sex is not None:
+                raise ValueError("The players of a sex aren't contiguous.")
+            return self.offsets[0], self.offsets[-1]
+        group = 2 * self._country_codes[country]
+        if sex is None:
+            return self.offsets[group], self.offsets[group + 2]
+        group += self.SEXES.index(sex)
+        return self.offsets[group], self.offsets[group + 1]
+
+    def get(self, country: Optional[str] = None, sex: Optional[str] = None):
+        """
+        Ratings of the players of `country` and `sex`, or of all of them if None.
+        The ratings of a single sex are sorted in ascending order. The ones of both
+        sexes of a country have its men first, but with `country` None as well
+        they're grouped by country, each with its men first, so slicing the first
+        men doesn't give the men of every country.
+        """
+        if country is None and sex is not None:
+            key = (country, sex)
+            if key not in self._cache:
+                first = self.SEXES.index(sex)
+                starts = self.offsets[first:-1:2]
+                ends = self.offsets[first + 1 :: 2]
+                self._cache[key] = np.sort(
+                    np.concatenate(
+                        [self.ratings[start:end] for start, end in zip(starts, ends)]
+                    )
+                )
+            return self._cache[key]
+        start, end = self.span(country, sex)
+        return self.ratings[start:end]
+
+    def _get_moments(self, country, sex) -> Tuple[int, float, float]:
+        key = (country, sex)
+        if key not in self._moments:
+            ratings = self.get(country, sex)
+            mean = np.mean(ratings)
+            self._moments[key] = len(ratings), mean, np.sum((ratings - mean) ** 2)
+        return self._moments[key]
+
+    def mean(self, country: Optional[str] = None, sex: Optional[str] = None) -> float:
+        return self._get_moments(country, sex)[1]
+
+    def std(
+        self, country: Optional[str] = None, sex: Optional[str] = None, ddof: int = 0
+    ) -> float:
+        count, _, m2 = self._get_moments(country, sex)
+        return np.sqrt(m2 / (count - ddof))
+
+
+def as_ratings_index(data: Union[pd.DataFrame, RatingsIndex]) -> RatingsIndex:
+    if isinstance(data, RatingsIndex):
+        return data
+    return RatingsIndex.from_dataframe(data)
+
+
+FIDE_COLUMNS = ["country", "sex", "rating", "birthday", "flag"]
+
+
+def _iter_fide_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(chunk_size, columns=FIDE_COLUMNS):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=FIDE_COLUMNS, chunksize=chunk_size)
+
+
+def read_fide_ratings(
+    path: str, max_birthday: Optional[int] = None, chunk_size: int = 100_000
+) -> RatingsIndex:
+    """
+    Read the active players (without flag, or with the "w" flag of women) of the
+    FIDE rating list in `path`, a parquet or csv file, born in `max_birthday` or
+    before. The file is streamed in chunks of `chunk_size` rows, keeping only
+    the country and sex of each player as integer codes and their rating as int16.
+    """
+    country_codes: Dict[str, int] = {}
+    codes, sexes, ratings = [], [], []
+    for chunk in _iter_fide_chunks(path, chunk_size):
+        keep = (
+            (chunk["flag"].isna() | (chunk["flag"] == "w"))
+            & chunk["sex"].isin(RatingsIndex.SEXES)
+            & chunk["country"].notna()
+            & chunk["rating"].notna()
+        )
+        if max_birthday is not None:
+            keep &= chunk["birthday"] <= max_birthday
+        chunk = chunk[keep]
+        chunk_codes, chunk_countries = pd.factorize(chunk["country"])
+        to_codes = np.array(
+            [country_codes.setdefault(c, len(country_codes)) for c in chunk_countries],
+            dtype=np.int16,
+        )
+        codes.append(to_codes[chunk_codes])
+        sexes.append((chunk["sex"] == "F").to_numpy(dtype=np.int8))
+        ratings.append(chunk["rating"].to_numpy(dtype=np.int16))
+
+    # Number the countries in alphabetical order
+    countries = np.array(list(country_codes), dtype=str)
+    order = np.argsort(countries)
+    sorted_codes = np.empty(len(countries), dtype=np.int16)
+    sorted_codes[order] = np.arange(len(countries))
+    return RatingsIndex.from_codes(
+        countries[order],
+        sorted_codes[np.concatenate(codes)] if codes else np.empty(0, np.int16),
+        np.concatenate(sexes) if sexes else np.empty(0, np.int8),
+        np.concatenate(ratings) if ratings else np.empty(0, np.int16),
+    )
+
+
+def load_fide_ratings(
+    path: str,
+    max_birthday: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    chunk_size: int = 100_000,
+) -> RatingsIndex:
+    """
+    `read_fide_ratings` cached in `cache_dir` (next to `path` by default). Later
+    calls with the same file and filters memory-map the cached index instead of
+    reading the file again.
+    """
+    cache_dir = cache_dir or f"{os.path.splitext(path)[0]}-index"
+    source_path = os.path.join(cache_dir, "source.json")
+    stat = os.stat(path)
+    source = {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "max_birthday": max_birthday,
+    }
+    if os.path.exists(source_path):
+        with open(source_path) as f:
+            if json.load(f) == source:
+                return RatingsIndex.load(cache_dir)
+        # The cache is stale, and it's invalid until it's rewritten
+        os.remove(source_path)
+    index = read_fide_ratings(path, max_birthday, chunk_size)
+    index.save(cache_dir)
+    with open(source_path, "w") as f:
+        json.dump(source, f)
+    return index
+
+
+def sample_max_differences(
+    ratings: np.ndarray, n_men: int, n_experiments: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Sample max(men) - max(women) after randomly shuffling who is a man and who is
+    a woman among `ratings`. Instead of shuffling the whole array, we sample how
+    many of the best players in a row share the sex of the best one, since the
+    next one is then the best player of the other sex.
+    """
+    elos = np.sort(ratings)[::-1]
+    n_total = len(elos)
+    n_women = n_total - n_men
+    # P(the best j players are men) and P(the best j players are women), j >= 1
+    men_first = np.cumprod((n_men - np.arange(n_men)) / (n_total - np.arange(n_men)))
+    women_first = np.cumprod(
+        (n_women - np.arange(n_women)) / (n_total - np.arange(n_women))
+    )
+    n_men_first = np.searchsorted(-men_first, -rng.random(n_experiments))
+    # Number of women in a row conditioned on the best player being a woman
+    n_women_first = np.searchsorted(
+        -women_first, -rng.random(n_experiments) * women_first[0]
+    )
+    return np.where(
+        n_men_first > 0,
+        elos[0] - elos[n_men_first],
+        elos[n_women_first] - elos[0],
+    )
+
+
+def _map(function: Callable, n_jobs: int, *iterables: Iterable) -> list:
+    """`map` on a process pool with `n_jobs` workers, or serially if it's 1."""
+    if n_jobs == 1:
+        return list(tqdm(map(function, *iterables), total=len(iterables[0])))
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(tqdm(executor.map(function, *iterables), total=len(iterables[0])))
+
+
+def _share(array: np.ndarray, directory: str, name: str) -> str:
+    """
+    Save `array` so the workers can memory-map it instead of receiving a pickled
+    copy of it.
+    """
+    path = os.path.join(directory, f"{name}.npy")
+    np.save(path, array)
+    return path
+
+
+def _country_difference(
+    elos: np.ndarray, n_men: int, n_experiments: int, rng: np.random.Generator
+) -> Tuple[float, float, float]:
+    # The ratings of the men and the ones of the women are sorted, men first
+    actual_diff = elos[n_men - 1] - elos[-1]
+    diff = sample_max_differences(elos, n_men, n_experiments, rng)
+    return actual_diff, np.mean(diff), np.std(diff)
+
+
+def _shared_country_difference(
+    ratings_path: str,
+    start: int,
+    end: int,
+    n_men: int,
+    n_experiments: int,
+    rng: np.random.Generator,
+) -> Tuple[float, float, float]:
+    elos = np.load(ratings_path, mmap_mode="r")[start:end]
+    return _country_difference(elos, n_men, n_experiments, rng)
+
+
 def compute_actual_and_expected_difference(
-    data: pd.DataFrame, countries: List[str], n_experiments: int = 100
+    data: Union[pd.DataFrame, RatingsIndex],
+    countries: List[str],
+    n_experiments: int = 100,
+    rng: Optional[np.random.Generator] = None,
+    n_jobs: int = 1,
 ) -> pd.DataFrame:
-    results = {"country": [], "mean diff": [], "std diff": [], "actual diff": []}
+    """
+    Compare the actual difference between the best man and the best woman of each
+    country with the one expected if sex and rating were independent.
 
-    for country in tqdm(countries):
-        senior = data[(data["country"] == country)].copy()
-        actual_diff = max(senior[senior["sex"] == "M"]["rating"]) - max(
-            senior[senior["sex"] == "F"]["rating"]
+    Each country gets its own random stream spawned from `rng`, so running the
+    countries in `n_jobs` processes gives exactly the same results as running them
+    serially.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    rngs = rng.spawn(len(countries))
+    index = as_ratings_index(data)
+    n_men = [len(index.get(country, "M")) for country in countries]
+
+    n_countries = len(countries)
+    if n_jobs == 1:
+        elos = [index.get(country) for country in countries]
+        stats = _map(
+            _country_difference, 1, elos, n_men, [n_experiments] * n_countries, rngs
         )
-        n_men = len(senior[senior["sex"] == "M"])
-        elos = senior["rating"].values
-        diff = []
-        for i in range(n_experiments):
-            np.random.shuffle(elos)
-            men_elos = elos[:n_men]
-            women_elos = elos[n_men:]
-            diff.append(max(men_elos) - max(women_elos))
-        diff = np.array(diff)
-        results["country"].append(country)
-        results["mean diff"].append(np.mean(diff))
-        results["std diff"].append(np.std(diff))
-        results["actual diff"].append(actual_diff)
+    else:
+        starts, ends = zip(*map(index.span, countries)) if countries else ((), ())
+        with tempfile.TemporaryDirectory() as directory:
+            ratings_path = _share(index.ratings, directory, "ratings")
+            stats = _map(
+                _shared_country_difference,
+                n_jobs,
+                [ratings_path] * n_countries,
+                starts,
+                ends,
+                n_men,
+                [n_experiments] * n_countries,
+                rngs,
+            )
+
+    actual_diff, mean_diff, std_diff = zip(*stats) if stats else ([], [], [])
+    results = {
+        "country": list(countries),
+        "mean diff": list(mean_diff),
+        "std diff": list(std_diff),
+        "actual diff": list(actual_diff),
+    }
     results = pd.DataFrame(results)
     return results
 
 
+# Harmonic numbers H(0), H(1), ..., grown on demand by H.
+_HARMONIC_NUMBERS = np.zeros(1)
+
+
 def H(k):
-    return sum([j ** (-1) for j in range(1, k + 1)])
+    """k-th harmonic number, vectorized over `k`."""
+    global _HARMONIC_NUMBERS
+    k = np.asarray(k)
+    k_max = int(k.max(initial=0))
+    if k_max >= len(_HARMONIC_NUMBERS):
+        size = max(k_max + 1, 2 * len(_HARMONIC_NUMBERS))
+        _HARMONIC_NUMBERS = np.concatenate(
+            [[0.0], np.cumsum(1 / np.arange(1, size, dtype=float))]
+        )
+    return _HARMONIC_NUMBERS[k]
 
 
-def f(n, k):
-    r = 1
-    for _ in range(k):
-        r *= n
-        n -= 1
-    return r
+def log_f(n, k):
+    """Logarithm of the falling factorial n (n - 1) ... (n - k + 1)."""
+    return gammaln(n + 1) - gammaln(n - np.asarray(k) + 1)
 
 
 def expected_elo_bilalic(n, k, mu, sigma, c1=1.25, c2=0.287):
-    return (mu + c1 * sigma) + c2 * sigma * (f(n, k) / n**k * (log(n) - H(k - 1)))
+    # f(n, k) / n**k, without the huge integers
+    ratio = np.exp(log_f(n, k) - k * np.log(n))
+    return (mu + c1 * sigma) + c2 * sigma * (ratio * (np.log(n) - H(k - 1)))
 
 
 def expected_elo_blom(n, k, mu, sigma, alpha=0.375):
     return mu + ndtri(((n - k + 1) - alpha) / (n - 2 * alpha + 1)) * sigma
 
 
+# Upper bound on the number of values handled at once when computing order
+# statistics, so memory doesn't grow with the number of experiments.
+MAX_SAMPLE_ELEMENTS = 2**22
+
+
+# Half width of the integration grid of expected_elo_exact, in standard deviations
+# of the order statistic (approximated by the delta method around Blom's mean).
+QUADRATURE_WIDTH = 16
+QUADRATURE_POINTS = 1025
+
+
+def expected_elo_exact(n, k, mu, sigma) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Mean and std of the k-th best of `n` gaussian ratings, vectorized over `k`.
+
+    They're computed by integrating the density of the order statistic,
+        n! / ((k - 1)! (n - k)!) * Phi(x)^(n - k) * (1 - Phi(x))^(k - 1) * phi(x)
+    which we evaluate in log space (it's a product of huge and tiny numbers) and
+    normalize numerically on the grid, so the factorials cancel out. The grid of
+    each k is centered around the mean given by Blom's approximation, and the
+    density is smooth and vanishes at its ends, so the trapezoidal rule on an
+    uniform grid converges very fast.
+    """
+    ks = np.atleast_1d(k).astype(float)
+    grid = np.linspace(-QUADRATURE_WIDTH, QUADRATURE_WIDTH, QUADRATURE_POINTS)
+    chunk = max(1, MAX_SAMPLE_ELEMENTS // QUADRATURE_POINTS)
+    means, stds = [], []
+    for start in range(0, len(ks), chunk):
+        k_chunk = ks[start : start + chunk, None]
+        p = (n - k_chunk + 1 - 0.375) / (n + 0.25)
+        center = ndtri(p)
+        scale = np.sqrt(p * (1 - p) / n) / norm.pdf(center)
+        x = center + scale * grid
+        log_density = (
+            (n - k_chunk) * log_ndtr(x) + (k_chunk - 1) * log_ndtr(-x) - x**2 / 2
+        )
+        weights = np.exp(log_density - log_density.max(axis=1, keepdims=True))
+        weights /= weights.sum(axis=1, keepdims=True)
+        mean = (weights * x).sum(axis=1)
+        means.append(mean)
+        stds.append(np.sqrt((weights * (x - mean[:, None]) ** 2).sum(axis=1)))
+    mean, std = mu + sigma * np.concatenate(means), sigma * np.concatenate(stds)
+    if np.ndim(k) == 0:
+        return mean[0], std[0]
+    return mean, std
+
+
+def _chunk_sizes(n: int, n_experiments: int) -> List[int]:
+    chunk = max(1, MAX_SAMPLE_ELEMENTS // max(n, 1))
+    return [
+        min(chunk, n_experiments - start) for start in range(0, n_experiments, chunk)
+    ]
+
+
+def _top_moments(sample: np.ndarray, n_top: int) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Number of rows, mean and sum of squared deviations of the `n_top` largest
+    values of each row of `sample`, largest first.
+    """
+    n = sample.shape[1]
+    if n_top == 0 or n == 0:
+        return len(sample), np.empty(0), np.empty(0)
+    top = np.partition(sample, n - n_top, axis=1)[:, n - n_top :]
+    top = np.sort(top, axis=1)[:, ::-1]
+    mean = top.mean(axis=0)
+    return len(top), mean, ((top - mean) ** 2).sum(axis=0)
+
+
+def _merge_moments(
+    moments: Iterable[Tuple[int, np.ndarray, np.ndarray]],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Combine the moments of each chunk (Chan et al.) into a mean and a std."""
+    count, mean, m2 = 0, 0.0, 0.0
+    for chunk_count, chunk_mean, chunk_m2 in moments:
+        total = count + chunk_count
+        delta = chunk_mean - mean
+        mean = mean + delta * chunk_count / total
+        m2 = m2 + chunk_m2 + delta**2 * count * chunk_count / total
+        count = total
+    return mean, np.sqrt(m2 / count)
+
+
+def _gaussian_top_moments(mu, sigma, n, n_top, size, rng):
+    return _top_moments(rng.normal(mu, sigma, size=(size, n)), n_top)
+
+
+def _bootstrap_top_moments(ratings, n, n_top, size, rng):
+    return _top_moments(rng.choice(ratings, size=(size, n)), n_top)
+
+
+def _shared_bootstrap_top_moments(ratings_path, n, n_top, size, rng):
+    ratings = np.load(ratings_path, mmap_mode="r")
+    return _bootstrap_top_moments(ratings, n, n_top, size, rng)
+
+
+def expected_elos_from_gaussian(
+    n: int,
+    n_top: int,
+    mu: float,
+    sigma: float,
+    n_experiments: int = 100,
+    rng: Optional[np.random.Generator] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Mean and std of the k-th best of `n` gaussian ratings for every k in
+    1..n_top, from a single sample per experiment.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    sizes = _chunk_sizes(n, n_experiments)
+    return _merge_moments(
+        _gaussian_top_moments(mu, sigma, n, n_top, size, chunk_rng)
+        for size, chunk_rng in zip(sizes, rng.spawn(len(sizes)))
+    )
+
+
 def expected_elo_from_gaussian(
-    n, k, mu, sigma, n_experiments=100
+    n, k, mu, sigma, n_experiments=100, rng=None
 ) -> Tuple[float, float]:
-    x = np.sort(norm(mu, sigma).rvs(size=(n_experiments, n)))
-    return np.mean(x[:, -k]), np.std(x[:, -k])
+    mean, std = expected_elos_from_gaussian(n, k, mu, sigma, n_experiments, rng)
+    return mean[k - 1], std[k - 1]
+
+
+def expected_elos_bootstrapping(
+    ns: Sequence[int],
+    n_top: int,
+    ratings: np.ndarray,
+    n_experiments: int = 100,
+    rng: Optional[np.random.Generator] = None,
+    n_jobs: int = 1,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Mean and std of the k-th best of `n` players drawn with replacement from
+    `ratings`, for every k in 1..n_top and every `n` in `ns`.
+
+    Each experiment draws its sample once and gets all the order statistics from
+    it. The experiments are split in chunks of bounded size, and each chunk gets
+    its own random stream spawned from `rng`, so running the chunks in `n_jobs`
+    processes gives exactly the same results as running them serially.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    tasks = [(n, size) for n in ns for size in _chunk_sizes(n, n_experiments)]
+    task_ns, sizes = zip(*tasks) if tasks else ((), ())
+    n_tasks = len(tasks)
+    rngs = rng.spawn(n_tasks)
+    if n_jobs == 1:
+        moments = _map(
+            _bootstrap_top_moments,
+            1,
+            [ratings] * n_tasks,
+            task_ns,
+            [n_top] * n_tasks,
+            sizes,
+            rngs,
+        )
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            ratings_path = _share(ratings, directory, "ratings")
+            moments = _map(
+                _shared_bootstrap_top_moments,
+                n_jobs,
+                [ratings_path] * n_tasks,
+                task_ns,
+                [n_top] * n_tasks,
+                sizes,
+                rngs,
+            )
+    results = []
+    for n in ns:
+        n_chunks = len(_chunk_sizes(n, n_experiments))
+        results.append(_merge_moments(moments[:n_chunks]))
+        moments = moments[n_chunks:]
+    return results
 
 
-def expected_elo_bootstrapping(n, k, ratings, n_experiments=100):
-    ratings = ratings.copy()
-    x = np.sort(np.random.choice(ratings, size=(n_experiments, n)))
-    return np.mean(x[:, -k]), np.std(x[:, -k])
+def expected_elo_bootstrapping(n, k, ratings, n_experiments=100, rng=None):
+    [(mean, std)] = expected_elos_bootstrapping([n], k, ratings, n_experiments, rng)
+    return mean[k - 1], std[k - 1]
 
 
 def bilalic_vs_blom(
@@ -74,75 +577,50 @@ def bilalic_vs_blom(
     sigma: float,
     ks: Sequence[int],
 ):
-    blom = []
-    bilalic = []
-    numeric = []
-    numeric_std = []
-    for k in tqdm(ks):
-        blom.append(expected_elo_blom(n, k, mu, sigma))
-        bilalic.append(expected_elo_bilalic(n, k, mu, sigma))
-        mean, std = expected_elo_from_gaussian(n, k, mu, sigma)
-        numeric.append(mean)
-        numeric_std.append(std)
+    ks = np.asarray(ks)
+    numeric, numeric_std = expected_elo_exact(n, ks, mu, sigma)
 
     return {
-        "blom": np.array(blom),
-        "bilalic": np.array(bilalic),
-        "numeric": np.array(numeric),
-        "numeric std": np.array(numeric_std),
+        "blom": expected_elo_blom(n, ks, mu, sigma),
+        "bilalic": expected_elo_bilalic(n, ks, mu, sigma),
+        "numeric": numeric,
+        "numeric std": numeric_std,
     }
 
 
 def compute_actual_and_expected_differences_top_players(
-    data: pd.DataFrame,
+    data: Union[pd.DataFrame, RatingsIndex],
     country: Optional[str] = None,
     n: int = 100,
     n_experiments: int = 100,
+    rng: Optional[np.random.Generator] = None,
+    n_jobs: int = 1,
 ) -> dict:
-    if country:
-        df_country = data[(data["country"] == country)].copy()
-    else:
-        df_country = data.copy()
-    ratings = df_country["rating"].values.copy()
-    elos_male = df_country[df_country["sex"] == "M"]["rating"].values
-    elos_female = df_country[df_country["sex"] == "F"]["rating"].values
+    index = as_ratings_index(data)
+    country = country or None
+    ratings = index.get(country)
+    elos_male = index.get(country, "M")
+    elos_female = index.get(country, "F")
     n_male = len(elos_male)
     n_female = len(elos_female)
     n = min([n_male, n_female, n])
 
     # Calculate the real differences
-    top_elos_male = sorted(elos_male, reverse=True)[:n]
-    top_elos_female = sorted(elos_female, reverse=True)[:n]
-    real_diffs = np.array([top_elos_male[i] - top_elos_female[i] for i in range(n)])
+    real_diffs = elos_male[::-1][:n] - elos_female[::-1][:n]
 
-    # Bootstrap difference
-    n_male = len(elos_male)
-    n_female = len(elos_female)
-    bootstrap_male = [
-        expected_elo_bootstrapping(
-            n=n_male, k=i, ratings=ratings, n_experiments=n_experiments
-        )
-        for i in range(1, n + 1)
-    ]
-    bootstrap_female = [
-        expected_elo_bootstrapping(
-            n=n_female, k=i, ratings=ratings, n_experiments=n_experiments
+    # Bootstrap difference, nothing to compare if one of the sexes has no players
+    if n:
+        (male_mean, male_std), (female_mean, female_std) = expected_elos_bootstrapping(
+            [n_male, n_female], n, ratings, n_experiments, rng, n_jobs
         )
-        for i in range(1, n + 1)
-    ]
-
-    bootstrap_expected_difference = np.array(
-        [bootstrap_male[i][0] - bootstrap_female[i][0] for i in range(n)]
-    )
-    bootstrap_expected_std = np.array(
-        [
-            np.sqrt(bootstrap_male[i][1] ** 2 + bootstrap_female[i][1] ** 2)
-            for i in range(n)
-        ]
-    )
+        bootstrap_expected_difference = male_mean - female_mean
+        bootstrap_expected_std = np.sqrt(male_std**2 + female_std**2)
+    else:
+        bootstrap_expected_difference = np.empty(0)
+        bootstrap_expected_std = np.empty(0)
     # Normal assumption difference
-    mu = df_country["rating"].mean()
-    sigma = df_country["rating"].std()
+    mu = index.mean(country)
+    sigma = index.std(country, ddof=1)
     print(mu, sigma)
     simulated_male = [
         expected_elo_blom(n=n_male, k=i, mu=mu, sigma=sigma) for i in range(1, n + 1)
@@ -1,30 +1,165 @@
-import bisect
+import csv
 import datetime
 from collections.abc import MutableMapping
-from typing import Iterator
+from typing import Dict, Iterable, Iterator, Sequence, Tuple
+
+import numpy as np
+
+KEY_DTYPE = "datetime64[us]"
+# Upper bound on the number of prices looked up at once by `backtest`
+MAX_LOOKUPS = 2**22
 
 
 class ClosestIndexDict(MutableMapping):
+    """
+    Mapping from dates to prices where looking up a date that isn't a key gives
+    the value of the closest key after it.
+
+    Keys and values are kept in sorted datetime64/float64 arrays. Inserts are
+    buffered and only merged into the arrays when they're read, so setting the
+    items one by one doesn't pay a sorted insert each time.
+    """
+
     def __init__(self) -> None:
-        self._dict = dict()
-        self._keys = sorted(list(self._dict.keys()))
+        self._keys = np.empty(0, dtype=KEY_DTYPE)
+        self._values = np.empty(0, dtype=np.float64)
+        self._pending: Dict[np.datetime64, float] = {}
+
+    @classmethod
+    def from_arrays(cls, keys: Iterable, values: Iterable) -> "ClosestIndexDict":
+        """Build the mapping sorting the keys once. Later duplicates win."""
+        prices = cls()
+        prices._keys, prices._values = _merge(
+            prices._keys,
+            prices._values,
+            np.asarray(keys, dtype=KEY_DTYPE),
+            np.asarray(values, dtype=np.float64),
+        )
+        return prices
+
+    @classmethod
+    def from_series(cls, series) -> "ClosestIndexDict":
+        """Build the mapping from a pandas Series indexed by date."""
+        return cls.from_arrays(series.index.to_numpy(), series.to_numpy())
+
+    @classmethod
+    def from_csv(
+        cls, path: str, date_format: str = "%m/%d/%y", column: int = 4
+    ) -> "ClosestIndexDict":
+        """
+        Build the mapping from a CSV file with a header, the dates in the first
+        column and the prices in `column`.
+        """
+        with open(path, newline="") as file:
+            rows = csv.reader(file)
+            next(rows)
+            keys, values = [], []
+            for row in rows:
+                keys.append(datetime.datetime.strptime(row[0], date_format))
+                values.append(float(row[column]))
+        return cls.from_arrays(keys, values)
+
+    def _flush(self) -> None:
+        if self._pending:
+            self._keys, self._values = _merge(
+                self._keys,
+                self._values,
+                np.fromiter(self._pending.keys(), dtype=KEY_DTYPE),
+                np.fromiter(self._pending.values(), dtype=np.float64),
+            )
+            self._pending.clear()
+
+    def lookup_many(self, dates: Iterable) -> np.ndarray:
+        """Vectorized `__getitem__`: the values of the closest keys after `dates`."""
+        self._flush()
+        indices = np.searchsorted(self._keys, np.asarray(dates, dtype=KEY_DTYPE))
+        if np.any(indices >= len(self._keys)):
+            raise KeyError(f"{np.max(dates)} is outside the range")
+        return self._values[indices]
 
     def __getitem__(self, k: datetime.datetime) -> float:
-        ind = bisect.bisect_left(self._keys, k)
-        if ind >= len(self):
+        self._flush()
+        ind = np.searchsorted(self._keys, np.datetime64(k, "us"))
+        if ind >= len(self._keys):
             raise KeyError(f"{k} is outside the range")
-        return self._dict[self._keys[ind]]
+        return self._values[ind]
 
     def __setitem__(self, k: datetime.datetime, v: float) -> None:
-        self._dict[k] = v
-        bisect.insort(self._keys, k)
+        self._pending[np.datetime64(k, "us")] = v
 
     def __delitem__(self, k: datetime.datetime) -> None:
-        del self._dict[k]
-        self._keys.remove(k)
+        self._flush()
+        key = np.datetime64(k, "us")
+        ind = np.searchsorted(self._keys, key)
+        if ind >= len(self._keys) or self._keys[ind] != key:
+            raise KeyError(k)
+        self._keys = np.delete(self._keys, ind)
+        self._values = np.delete(self._values, ind)
 
     def __len__(self) -> int:
-        return len(self._dict)
+        self._flush()
+        return len(self._keys)
 
     def __iter__(self) -> Iterator:
-        yield from self._dict.keys()
+        self._flush()
+        yield from self._keys.tolist()
+
+
+def _merge(keys, values, new_keys, new_values):
+    """Merge two key/value arrays, the new ones winning over equal keys."""
+    keys = np.concatenate([keys, new_keys])
+    values = np.concatenate([values, new_values])
+    order = np.argsort(keys, kind="stable")
+    keys, values = keys[order], values[order]
+    # The stable sort leaves the newest value last among equal keys
+    last = np.append(keys[1:] != keys[:-1], True)
+    return keys[last], values[last]
+
+
+def date_range(
+    start: datetime.datetime, end: datetime.datetime, n_periods: float
+) -> np.ndarray:
+    """
+    Dates every `(end - start) / n_periods` from `start`, plus `end`. If
+    `n_periods` isn't an integer, the last period is shorter.
+    """
+    freq = (end - start) / n_periods
+    dates = np.arange(start, end, freq).astype(KEY_DTYPE)
+    return np.append(dates, np.datetime64(end, "us"))
+
+
+def _buy_offsets(length: datetime.timedelta, n_periods: float) -> np.ndarray:
+    """Offsets from the start date of the buy dates given by `date_range`."""
+    # Dividing the timedelta rounds the step to microseconds as date_range does
+    step = np.timedelta64(length / n_periods, "us")
+    return np.arange(np.timedelta64(0, "us"), np.timedelta64(length, "us"), step)
+
+
+def backtest(
+    prices: ClosestIndexDict,
+    start_dates: Iterable,
+    schedules: Sequence[Tuple[float, float]],
+) -> np.ndarray:
+    """
+    Benefit of investing 1 split in equal parts over each `(length, n_periods)`
+    schedule and selling everything `length` days after each start date. Buys
+    happen at the start of each of the `n_periods` periods, so `n_periods=1` is a
+    lump sum and higher values are dollar-cost averaging.
+
+    Returns a matrix with a row per schedule and a column per start date. The
+    buy dates of each schedule are the start dates plus the same offsets, so all
+    of them are looked up at once, in chunks of at most `MAX_LOOKUPS` prices.
+    """
+    starts = np.asarray(start_dates, dtype=KEY_DTYPE)
+    results = np.empty((len(schedules), len(starts)))
+    for row, (length, n_periods) in zip(results, schedules):
+        length = datetime.timedelta(days=length)
+        offsets = _buy_offsets(length, n_periods)
+        chunk = max(1, MAX_LOOKUPS // len(offsets))
+        for first in range(0, len(starts), chunk):
+            buy_dates = starts[first : first + chunk, None] + offsets
+            row[first : first + chunk] = np.mean(
+                1 / prices.lookup_many(buy_dates), axis=1
+            )
+        row *= prices.lookup_many(starts + np.timedelta64(length, "us"))
+    return results